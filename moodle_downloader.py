@@ -5,47 +5,273 @@ import re
 import sys
 import time
 import json
+import shutil
 import getpass
+import logging
 import argparse
 import requests
 import mimetypes
-from bs4 import BeautifulSoup
+import uuid
+import threading
+from email.message import Message
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin, urlparse, parse_qs, unquote
 from tqdm import tqdm
 
+# Prefer the much faster lxml parser, falling back to the stdlib one
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# Connect and read timeouts in seconds, so a stalled server can't hang a worker forever
+REQUEST_TIMEOUT = (10, 60)
+
+# Bytes read from the network per iteration while streaming a download
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Downloads at least this large are flushed and dropped from the page cache when done
+PAGE_CACHE_DROP_SIZE = 8 * 1024 * 1024
+
+# Record of previous downloads kept in the download directory
+MANIFEST_FILENAME = ".moodle_manifest.json"
+
+# Regex patterns used on every file and page, compiled once at import
+_SANITIZE_RE = re.compile(r'[\\/*?:"<>|]')
+_PDF_RE = re.compile(r'pdf=(\d+)')
+_DOC_RE = re.compile(r'doc=(\d+)')
+_CMID_RE = re.compile(r'cmid=(\d+)')
+_JS_ABS_URL_RE = re.compile(r'(https?://[^"\']*(?:pluginfile\.php|file\.php)[^"\'\s]*)')
+_JS_REL_URL_RE = re.compile(r'(\/[^"\']*(?:pluginfile\.php|file\.php)[^"\'\s]*)')
+_NON_FILE_LINK_RE = re.compile(r'forum|page/view|edit|delete|index')
+_COURSES_SELECTION_RE = re.compile(r'^\s*(all|\d+(\s*,\s*\d+)*)\s*$', re.IGNORECASE)
+
+# Tag filters for pages where only part of the document is needed, built once at import
+_INPUT_STRAINER = SoupStrainer("input")
+_COURSE_LIST_STRAINER = SoupStrainer(["a", "div", "li", "h3"])
+_LINK_STRAINER = SoupStrainer("a", href=True)
+
+# File formats recognised in URLs when no other extension source is available
+COMMON_FORMATS = {
+    # Documents
+    'pdf': '.pdf',
+    'docx': '.docx',
+    'doc': '.doc',
+    'pptx': '.pptx',
+    'ppt': '.ppt',
+    'xlsx': '.xlsx',
+    'xls': '.xls',
+    'txt': '.txt',
+    'rtf': '.rtf',
+    'odt': '.odt',
+    'ods': '.ods',
+    'odp': '.odp',
+
+    # Images
+    'jpg': '.jpg',
+    'jpeg': '.jpeg',
+    'png': '.png',
+    'gif': '.gif',
+    'svg': '.svg',
+    'bmp': '.bmp',
+    'tiff': '.tiff',
+    'tif': '.tif',
+
+    # Audio
+    'mp3': '.mp3',
+    'wav': '.wav',
+    'aac': '.aac',
+    'flac': '.flac',
+    'ogg': '.ogg',
+    'm4a': '.m4a',
+
+    # Video
+    'mp4': '.mp4',
+    'mov': '.mov',
+    'avi': '.avi',
+    'wmv': '.wmv',
+    'webm': '.webm',
+    'mkv': '.mkv',
+    'flv': '.flv',
+    'm4v': '.m4v',
+
+    # Archives
+    'zip': '.zip',
+    'rar': '.rar',
+    '7z': '.7z',
+    'tar': '.tar',
+    'gz': '.gz',
+    'tgz': '.tgz',
+
+    # Programming/Code
+    'py': '.py',
+    'java': '.java',
+    'html': '.html',
+    'htm': '.htm',
+    'css': '.css',
+    'js': '.js',
+    'sql': '.sql',
+    'r': '.r',
+    'm': '.m',
+    'c': '.c',
+    'cpp': '.cpp',
+    'h': '.h',
+    'ipynb': '.ipynb',
+
+    # Special Formats
+    'tex': '.tex',
+    'epub': '.epub',
+    'mobi': '.mobi',
+    'srt': '.srt',
+    'vtt': '.vtt',
+    'xml': '.xml',
+    'json': '.json',
+    'csv': '.csv',
+    'mm': '.mm',
+    'xmind': '.xmind',
+
+    # Learning-specific and others
+    'h5p': '.h5p',
+    'psd': '.psd',
+    'ai': '.ai',
+    'dwg': '.dwg',
+    'dxf': '.dxf',
+    'mus': '.mus',
+    'sib': '.sib',
+    'cdx': '.cdx',
+    'ggb': '.ggb'
+}
+
+# Link suffixes treated as downloadable files on resource pages (a tuple so endswith can take it)
+FILE_EXTENSIONS = ('.pdf', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.zip', '.rar', '.7z', '.mp3',
+                   '.mp4', '.avi', '.mov', '.jpg', '.jpeg', '.png', '.gif')
+
+# Matches any known format as a URL extension, longest names first (php is left out of
+# the table because every Moodle URL goes through pluginfile.php or view.php)
+_FORMAT_RE = re.compile(
+    r'\.(' + '|'.join(re.escape(k) for k in sorted(COMMON_FORMATS, key=len, reverse=True)) + r')(?:$|[?&/#])',
+    re.IGNORECASE
+)
+
+
+class _TqdmLoggingHandler(logging.Handler):
+    """Logging handler writing through tqdm so messages don't tear concurrent progress bars."""
+
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
 
 class MoodleDownloader:
-    def __init__(self, base_url, username=None, password=None, download_dir=None, verbose=True, force_download=False):
+    def __init__(self, base_url, username=None, password=None, download_dir=None, verbose=True, force_download=False,
+                 max_workers=8, courses_selection=None):
         self.base_url = base_url.rstrip('/')
         self.username = username
         self.password = password
         self.download_dir = download_dir or os.path.join(os.path.expanduser("~"), "Downloads", "MoodleContent")
         self.verbose = verbose
         self.force_download = force_download  # Add this line
+        self.logger = logging.getLogger("moodledl")
+        self.logger.setLevel(logging.INFO if verbose else logging.WARNING)
+        if not self.logger.handlers:
+            self.logger.addHandler(_TqdmLoggingHandler())
+            self.logger.propagate = False
+        self.courses_selection = courses_selection
         self.session = requests.Session()
 
+        # Downloads are network-bound, so run them concurrently on a worker pool
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = []
+        self._seen_urls = set()
+        self._created_dirs = set()
+        self._claimed_paths = {}
+        self._paths_lock = threading.Lock()
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+
+        # Reuse pooled keep-alive connections and retry transient gateway errors
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=max(32, max_workers),
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
         # Add headers to mimic a browser
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.5',
+            'Connection': 'keep-alive',
         })
 
         # Initialize mimetypes
         mimetypes.init()
 
-    def log(self, message):
-        """Print messages if verbose mode is enabled."""
-        if self.verbose:
-            print(message)
+        # Validators of previous downloads, used for conditional requests on re-runs
+        self.manifest_path = os.path.join(self.download_dir, MANIFEST_FILENAME)
+        self._manifest_lock = threading.Lock()
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        """Load the manifest of previous downloads, if there is one."""
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+        manifest.setdefault("files", {})
+        manifest.setdefault("redirects", {})
+        manifest.setdefault("courses", {})
+        return manifest
+
+    def save_manifest(self):
+        """Write the manifest of downloads to the download directory."""
+        with self._manifest_lock:
+            data = json.dumps(self.manifest)
+
+        # Write a temporary file and swap it in, so an interrupted save never leaves a truncated manifest
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _record_download(self, url, response, full_path):
+        """Remember a download's validators so the next run can ask whether it changed."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+
+        with self._manifest_lock:
+            self.manifest["files"][url] = {
+                "path": full_path,
+                "etag": etag,
+                "last_modified": last_modified,
+                "size": os.path.getsize(full_path)
+            }
+
+    def log(self, message, *args):
+        """Log messages shown in verbose mode; %-style args are only formatted if shown."""
+        self.logger.info(message, *args)
 
     def login(self):
         """Log in to Moodle."""
         login_url = urljoin(self.base_url, "/login/index.php")
 
         # Get the login page to retrieve CSRF token
-        response = self.session.get(login_url)
-        soup = BeautifulSoup(response.text, "html.parser")
+        response = self.session.get(login_url, timeout=REQUEST_TIMEOUT)
+        soup = BeautifulSoup(response.text, HTML_PARSER, parse_only=_INPUT_STRAINER)
 
         # Try different token field names used by various Moodle versions
         token = None
@@ -76,16 +302,26 @@ class MoodleDownloader:
         }
 
         # Submit login form
-        response = self.session.post(login_url, data=login_data)
+        response = self.session.post(login_url, data=login_data, timeout=REQUEST_TIMEOUT)
 
         # Check if login was successful by looking for common login page indicators
         if any(x in response.text for x in ["Log in to the site", "loginform", "Login to your account"]):
             self.log("Login failed. Please check your credentials.")
             sys.exit(1)
 
+        self._login_generation += 1
         self.log("Login successful!")
         return True
 
+    def _relogin(self, login_generation):
+        """Log in again after the session expired, unless another thread already has."""
+        with self._login_lock:
+            # A newer generation means a re-login finished since the caller's request was sent
+            if self._login_generation != login_generation:
+                return
+            self.log("Session expired. Logging in again...")
+            self.login()
+
     def get_courses(self):
         """Get list of enrolled courses from various Moodle pages."""
         courses = []
@@ -97,13 +333,51 @@ class MoodleDownloader:
             "/course/index.php"  # All courses
         ]
 
-        for page in course_pages:
+        # The dedicated courses page usually suffices; only fall back when it yields nothing
+        courses.extend(self._fetch_courses(course_pages[:1]))
+        if not courses:
+            courses.extend(self._fetch_courses(course_pages[1:]))
+
+        # Remove duplicates
+        unique_courses = []
+        seen_urls = set()
+
+        for course in courses:
+            if course["url"] not in seen_urls:
+                seen_urls.add(course["url"])
+                unique_courses.append(course)
+
+        return unique_courses
+
+    def _fetch_courses(self, pages):
+        """Fetch course list pages concurrently and extract courses from them in order."""
+        courses = []
+
+        pending_pages = []
+        for page in pages:
             url = urljoin(self.base_url, page)
             self.log(f"Checking for courses at: {url}")
 
+            # Revalidate the course list cached by a previous run instead of re-parsing it
+            headers = {}
+            cached = self.manifest["courses"].get(url)
+            if cached:
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified"):
+                    headers["If-Modified-Since"] = cached["last_modified"]
+
+            future = self.executor.submit(self.session.get, url, headers=headers, timeout=REQUEST_TIMEOUT)
+            pending_pages.append((page, url, cached, future))
+
+        for page, url, cached, future in pending_pages:
             try:
-                response = self.session.get(url)
-                courses_found = self._extract_courses_from_page(response.text)
+                response = future.result()
+                if response.status_code == 304 and cached:
+                    courses_found = cached["courses"]
+                else:
+                    courses_found = self._extract_courses_from_page(response.text)
+                    self._record_courses(url, response, courses_found)
 
                 if courses_found:
                     courses.extend(courses_found)
@@ -111,21 +385,27 @@ class MoodleDownloader:
             except Exception as e:
                 self.log(f"Error accessing {page}: {str(e)}")
 
-        # Remove duplicates
-        unique_courses = []
-        seen_urls = set()
+        return courses
 
-        for course in courses:
-            if course["url"] not in seen_urls:
-                seen_urls.add(course["url"])
-                unique_courses.append(course)
+    def _record_courses(self, url, response, courses):
+        """Cache a course list page's courses if the server sent validators for it."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not courses or (not etag and not last_modified):
+            return
 
-        return unique_courses
+        with self._manifest_lock:
+            self.manifest["courses"][url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "courses": courses
+            }
 
     def _extract_courses_from_page(self, html_content):
         """Extract course information from HTML content using multiple selector methods."""
         courses = []
-        soup = BeautifulSoup(html_content, "html.parser")
+        # Only course cards and links are needed, so skip building the rest of the tree
+        soup = BeautifulSoup(html_content, HTML_PARSER, parse_only=_COURSE_LIST_STRAINER)
 
         # Method 1: Modern Moodle dashboard cards
         for card in soup.select(".dashboard-card, .coursebox, .course-info-container"):
@@ -140,12 +420,11 @@ class MoodleDownloader:
 
         # Method 2: Direct course links
         if not courses:
-            for link in soup.find_all("a", href=True):
-                if "course/view.php" in link.get("href", ""):
-                    courses.append({
-                        "url": link["href"],
-                        "name": link.get_text(strip=True) or "Unnamed Course"
-                    })
+            for link in soup.select('a[href*="course/view.php"]'):
+                courses.append({
+                    "url": link["href"],
+                    "name": link.get_text(strip=True) or "Unnamed Course"
+                })
 
         # Ensure all URLs are absolute
         for course in courses:
@@ -168,7 +447,8 @@ class MoodleDownloader:
         _, ext = os.path.splitext(filename)
 
         # If extension exists in URL and is reasonable length, use it
-        if ext and len(ext) <= 10:
+        # (.php is the Moodle endpoint serving the file, not the file type)
+        if ext and len(ext) <= 10 and ext.lower() != '.php':
             return ext
 
         # Priority 3: Use content-type header
@@ -179,147 +459,107 @@ class MoodleDownloader:
                 return ext
 
         # Priority 4: Check for common file patterns in URL
-        pdf_pattern = re.search(r'pdf=(\d+)', url)
+        pdf_pattern = _PDF_RE.search(url)
         if pdf_pattern:
             return '.pdf'
 
-        doc_pattern = re.search(r'doc=(\d+)', url)
+        doc_pattern = _DOC_RE.search(url)
         if doc_pattern:
             return '.doc'
 
         # Check if there's a common format mentioned in the URL
-        common_formats = {
-            # Documents
-            'pdf': '.pdf',
-            'docx': '.docx',
-            'doc': '.doc',
-            'pptx': '.pptx',
-            'ppt': '.ppt',
-            'xlsx': '.xlsx',
-            'xls': '.xls',
-            'txt': '.txt',
-            'rtf': '.rtf',
-            'odt': '.odt',
-            'ods': '.ods',
-            'odp': '.odp',
-
-            # Images
-            'jpg': '.jpg',
-            'jpeg': '.jpeg',
-            'png': '.png',
-            'gif': '.gif',
-            'svg': '.svg',
-            'bmp': '.bmp',
-            'tiff': '.tiff',
-            'tif': '.tif',
-
-            # Audio
-            'mp3': '.mp3',
-            'wav': '.wav',
-            'aac': '.aac',
-            'flac': '.flac',
-            'ogg': '.ogg',
-            'm4a': '.m4a',
-
-            # Video
-            'mp4': '.mp4',
-            'mov': '.mov',
-            'avi': '.avi',
-            'wmv': '.wmv',
-            'webm': '.webm',
-            'mkv': '.mkv',
-            'flv': '.flv',
-            'm4v': '.m4v',
-
-            # Archives
-            'zip': '.zip',
-            'rar': '.rar',
-            '7z': '.7z',
-            'tar': '.tar',
-            'gz': '.gz',
-            'tgz': '.tgz',
-
-            # Programming/Code
-            'py': '.py',
-            'java': '.java',
-            'html': '.html',
-            'htm': '.htm',
-            'css': '.css',
-            'js': '.js',
-            'php': '.php',
-            'sql': '.sql',
-            'r': '.r',
-            'm': '.m',
-            'c': '.c',
-            'cpp': '.cpp',
-            'h': '.h',
-            'ipynb': '.ipynb',
-
-            # Special Formats
-            'tex': '.tex',
-            'epub': '.epub',
-            'mobi': '.mobi',
-            'srt': '.srt',
-            'vtt': '.vtt',
-            'xml': '.xml',
-            'json': '.json',
-            'csv': '.csv',
-            'mm': '.mm',
-            'xmind': '.xmind',
-
-            # Learning-specific and others
-            'h5p': '.h5p',
-            'psd': '.psd',
-            'ai': '.ai',
-            'dwg': '.dwg',
-            'dxf': '.dxf',
-            'mus': '.mus',
-            'sib': '.sib',
-            'cdx': '.cdx',
-            'ggb': '.ggb'
-        }
-
-        for format_name, extension in common_formats.items():
-            if format_name in url.lower():
-                return extension
+        format_match = _FORMAT_RE.search(url)
+        if format_match:
+            return COMMON_FORMATS[format_match.group(1).lower()]
 
         # Final fallback - return a sensible default
         return '.bin'
 
-    def download_file(self, url, path, filename=None):
+    def download_file(self, url, path, filename=None, conditional=True):
         """Download a file with progress bar. Skips if file already exists."""
         try:
             # Ensure the URL is absolute
             if not url.startswith(("http://", "https://")):
                 url = urljoin(self.base_url, url)
 
-            # Make a HEAD request first to get headers without downloading content
-            head_response = self.session.head(url, allow_redirects=True)
+            # Files are stored as-is, so ask for them uncompressed; this skips decoding
+            # and keeps Content-Length equal to the size on disk for the skip check
+            headers = {'Accept-Encoding': 'identity'}
 
-            # If the request was redirected to a login page, login has expired
-            if "login" in head_response.url and "login" not in url:
-                self.log("Session expired. Logging in again...")
-                self.login()
-                return self.download_file(url, path, filename)
+            # Ask the server to skip the body if the file is unchanged since the last run
+            entry = self.manifest["files"].get(url)
+            if entry and conditional and not self.force_download and self._entry_on_disk(entry):
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
 
-            # Now make a streaming request for the actual download
-            response = self.session.get(url, stream=True)
+            # Stream the download; headers arrive before any of the body is read
+            login_generation = self._login_generation
+            response = self.session.get(url, stream=True, allow_redirects=True, headers=headers,
+                                        timeout=REQUEST_TIMEOUT)
 
+            # If the request was redirected to a login page, login has expired
+            if "login" in response.url and "login" not in url:
+                response.close()
+                self._relogin(login_generation)
+                return self.download_file(url, path, filename, conditional)
+
+            if response.status_code == 304:
+                # Read the empty body so the connection goes back to the pool instead of closing
+                response.content
+                response.close()
+                # Keep the unchanged file's name from being handed to another download
+                if self._claim_path(entry["path"], url) == entry["path"]:
+                    self.log(f"Skipping unchanged file: {os.path.basename(entry['path'])}")
+                    return entry["path"]
+                # Another download already holds that name this run, so fetch the file again
+                return self.download_file(url, path, filename, conditional=False)
+
+            # Don't save error pages as files
+            if not response.ok:
+                response.close()
+                response.raise_for_status()
+
+            return self._save_response(response, url, path, filename)
+        except Exception as e:
+            self.log(f"Error downloading {url}: {str(e)}")
+            return None
+
+    @staticmethod
+    def _entry_on_disk(entry):
+        """Check that the file recorded in a manifest entry is still the one on disk."""
+        try:
+            return os.stat(entry["path"]).st_size == entry.get("size")
+        except OSError:
+            return False
+
+    def _claim_path(self, full_path, url):
+        """Reserve a target path for this URL, numbering the name if another URL holds it."""
+        base, ext = os.path.splitext(full_path)
+        candidate = full_path
+        n = 1
+        with self._paths_lock:
+            while self._claimed_paths.setdefault(candidate, url) != url:
+                candidate = f"{base} ({n}){ext}"
+                n += 1
+        return candidate
+
+    def _save_response(self, response, url, path, filename=None):
+        """Write an open streaming response to disk. Skips if file already exists."""
+        try:
             # Get filename from Content-Disposition header or URL if not provided
             original_filename = None
             if not filename:
-                if 'Content-Disposition' in response.headers:
-                    cd = response.headers.get('Content-Disposition')
-                    filename_match = re.findall('filename="(.+?)"', cd)
-                    if filename_match:
-                        original_filename = filename_match[0]
-                        filename = original_filename
-                    else:
-                        original_filename = os.path.basename(urlparse(url).path)
-                        filename = original_filename
-                else:
+                cd = response.headers.get('Content-Disposition')
+                if cd:
+                    # The email parser also decodes RFC 5987 filename*=UTF-8''... values
+                    disposition = Message()
+                    disposition['Content-Disposition'] = cd
+                    original_filename = disposition.get_filename()
+                if not original_filename:
                     original_filename = os.path.basename(urlparse(url).path)
-                    filename = original_filename
+                filename = original_filename
 
                 # Clean up filename if it contains query parameters
                 if '?' in filename:
@@ -334,25 +574,37 @@ class MoodleDownloader:
                     filename = f"{filename}{new_ext}"
                     self.log(f"Added extension to file: {filename}")
 
-            # Create full path
-            full_path = os.path.join(path, self.sanitize_filename(filename))
+            # Create full path, reserved so no concurrent download writes the same file
+            full_path = self._claim_path(os.path.join(path, self.sanitize_filename(filename)), url)
+            filename = os.path.basename(full_path)
 
             # Ensure directory exists
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            self._ensure_dir(os.path.dirname(full_path))
 
-            # Check if file already exists and has content
-            if not self.force_download and os.path.exists(full_path) and os.path.getsize(full_path) > 0:
-                # Get size of existing file
-                existing_size = os.path.getsize(full_path)
+            # Get size and modification time of existing file with a single stat call
+            try:
+                existing_stat = os.stat(full_path)
+                existing_size, existing_mtime = existing_stat.st_size, existing_stat.st_mtime
+            except FileNotFoundError:
+                existing_size, existing_mtime = 0, 0
+
+            remote_mtime = self._remote_mtime(response)
 
+            # Check if file already exists and has content
+            if not self.force_download and existing_size > 0:
                 # Get expected file size
                 expected_size = int(response.headers.get('content-length', 0))
 
                 # If file exists and either matches expected size or expected size is unknown (0)
                 if expected_size == 0 or abs(
                         existing_size - expected_size) < 100:  # Allow small difference due to network issues
-                    self.log(f"Skipping existing file: {filename} ({existing_size} bytes)")
-                    return full_path
+                    # ...unless the server copy was modified after the local one
+                    if remote_mtime and remote_mtime > existing_mtime:
+                        self.log(f"File changed on server. Re-downloading: {filename}")
+                    else:
+                        self.log(f"Skipping existing file: {filename} ({existing_size} bytes)")
+                        self._record_download(url, response, full_path)
+                        return full_path
                 else:
                     self.log(f"File exists but size differs. Re-downloading: {filename}")
                     # Continue with download to replace the file
@@ -365,44 +617,105 @@ class MoodleDownloader:
                 self.log(f"Skipping empty file: {filename}")
                 return None
 
-            # Download with progress bar
-            with open(full_path, 'wb') as f:
-                with tqdm(
-                        desc=filename,
-                        total=total_size,
-                        unit='B',
-                        unit_scale=True,
-                        unit_divisor=1024,
-                        disable=not self.verbose
-                ) as bar:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            size = f.write(chunk)
-                            bar.update(size)
-
+            # Write to a uniquely named .part file and move it into place only once complete,
+            # so an interrupted download never looks like a finished file to the skip check
+            part_path = f"{full_path}.{uuid.uuid4().hex}.part"
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            try:
+                with open(fd, 'wb') as f:
+                    if not self.verbose:
+                        # No progress bar to feed, so let the C copy loop move the body
+                        response.raw.decode_content = True
+                        shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+                    else:
+                        # Download with progress bar
+                        with tqdm(
+                                desc=filename,
+                                total=total_size,
+                                unit='B',
+                                unit_scale=True,
+                                unit_divisor=1024,
+                                mininterval=0.5
+                        ) as bar:
+                            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                                if chunk:
+                                    f.write(chunk)
+                                    bar.update(len(chunk))
+
+                    # Nothing re-reads downloads, so let the kernel drop large ones from the page
+                    # cache; DONTNEED skips dirty pages, so flush the data to disk first
+                    if (total_size >= PAGE_CACHE_DROP_SIZE and hasattr(os, 'posix_fadvise')
+                            and hasattr(os, 'fdatasync')):
+                        try:
+                            f.flush()
+                            os.fdatasync(f.fileno())
+                            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                        except OSError:
+                            pass
+
+                os.replace(part_path, full_path)
+            except BaseException:
+                try:
+                    os.unlink(part_path)
+                except OSError:
+                    pass
+                raise
+
+            # Keep the server's modification time so later runs can compare against it
+            if remote_mtime:
+                os.utime(full_path, (remote_mtime, remote_mtime))
+
+            self._record_download(url, response, full_path)
             return full_path
         except Exception as e:
             self.log(f"Error downloading {url}: {str(e)}")
             return None
+        finally:
+            # Always hand the connection back to the pool, even when skipping or failing
+            response.close()
+
+    def _remote_mtime(self, response):
+        """Return the response's Last-Modified header as a timestamp, or None."""
+        last_modified = response.headers.get('Last-Modified')
+        if not last_modified:
+            return None
+        try:
+            return parsedate_to_datetime(last_modified).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def _ensure_dir(self, directory):
+        """Create a directory once, skipping the filesystem for ones already made."""
+        if directory in self._created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self._created_dirs.add(directory)
 
     def sanitize_filename(self, filename):
         """Make a string safe for use as a filename."""
         # Replace problematic characters
-        s = re.sub(r'[\\/*?:"<>|]', "_", filename)
+        s = _SANITIZE_RE.sub("_", filename)
         # Trim to reasonable length and remove trailing dots/spaces
         return s.strip(". ")[0:100]
 
-    def process_course(self, course):
-        """Process a single course and download all its content."""
+    def process_course(self, course, wait=True):
+        """Process a single course and download all its content.
+
+        With wait=False the downloads are left running on the worker pool so the
+        next course can be scanned meanwhile.
+        """
         self.log(f"\nProcessing course: {course['name']}")
 
+        # Links repeated across blocks and sections are only handled once per course
+        self._seen_urls = set()
+
         # Create course directory
         course_dir = os.path.join(self.download_dir, self.sanitize_filename(course['name']))
-        os.makedirs(course_dir, exist_ok=True)
+        self._ensure_dir(course_dir)
 
         # Get course page
-        response = self.session.get(course['url'])
-        soup = BeautifulSoup(response.text, "html.parser")
+        response = self.session.get(course['url'], timeout=REQUEST_TIMEOUT)
+        soup = BeautifulSoup(response.text, HTML_PARSER)
 
         # Extract course ID for potential API calls
         course_id = None
@@ -432,14 +745,45 @@ class MoodleDownloader:
 
             # Create section directory
             section_dir = os.path.join(course_dir, self.sanitize_filename(section_name))
-            os.makedirs(section_dir, exist_ok=True)
+            self._ensure_dir(section_dir)
+
+            # Walk the section's links once and share (href, text) pairs between the handlers
+            links = [(link["href"], link.get_text(strip=True)) for link in section_soup.select("a[href]")]
 
             # Process all resource types
-            self._process_resources(section_soup, section_dir)
-            self._process_folders(section_soup, section_dir)
-            self._process_assignments(section_soup, section_dir)
+            self._process_resources(links, section_dir)
+            self._process_folders(links, section_dir)
+            self._process_assignments(links, section_dir)
+
+        # Wait for the downloads queued for this course
+        if wait:
+            self._wait_for_downloads()
+            self.log(f"Completed processing course: {course['name']}")
+        else:
+            self.log(f"Queued downloads for course: {course['name']}")
+
+    def _is_new_url(self, href):
+        """Record a link for the current course, returning False if it was already handled."""
+        url = urljoin(self.base_url, href)
+        if url in self._seen_urls:
+            return False
+        self._seen_urls.add(url)
+        return True
+
+    def _submit(self, fn, *args):
+        """Queue a download task on the worker pool."""
+        future = self.executor.submit(fn, *args)
+        self._pending.append(future)
+        return future
 
-        self.log(f"Completed processing course: {course['name']}")
+    def _wait_for_downloads(self):
+        """Block until all queued download tasks have finished."""
+        pending, self._pending = self._pending, []
+        for future in as_completed(pending):
+            try:
+                future.result()
+            except Exception as e:
+                self.log(f"Error in download task: {str(e)}")
 
     def _get_course_sections(self, soup, course_id=None):
         """Extract course sections from the page."""
@@ -461,48 +805,46 @@ class MoodleDownloader:
 
         return sections
 
-    def _is_resource_link(self, link):
-        """Check if a link is likely a downloadable resource."""
-        href = link.get("href", "")
-
-        # Direct file downloads or resource pages
-        if any(x in href for x in ["pluginfile.php", "resource/view.php"]):
-            # Exclude common non-file links
-            if not any(x in href for x in ["forum", "page/view", "edit", "delete", "index"]):
-                return True
+    def _process_resources(self, links, directory):
+        """Process and download resource files from a section's (href, text) links."""
+        # Find direct file downloads or resource pages, excluding common non-file links
+        resource_links = [(href, text) for href, text in links
+                          if ("pluginfile.php" in href or "resource/view.php" in href)
+                          and not _NON_FILE_LINK_RE.search(href)]
 
-        return False
+        for url, name in resource_links:
+            # Skip empty resources or buttons
+            if not name or name.lower() in ["edit", "delete", "move"]:
+                continue
 
-    def _process_resources(self, soup, directory):
-        """Process and download resource files."""
-        # Find resource links - multiple selectors for different Moodle versions
-        resource_links = [link for link in soup.find_all("a", href=True) if self._is_resource_link(link)]
+            if not self._is_new_url(url):
+                continue
 
-        for link in resource_links:
-            try:
-                url = link["href"]
-                name = link.get_text(strip=True)
+            self.log(f"Found resource: {name}")
+            self._submit(self._download_resource, url, directory, name)
 
-                # Skip empty resources or buttons
-                if not name or name.lower() in ["edit", "delete", "move"]:
-                    continue
+    def _download_resource(self, url, directory, name):
+        """Download a single resource link, resolving resource pages if needed."""
+        try:
+            # Handle direct file downloads
+            if "pluginfile.php" in url:
+                downloaded_file = self.download_file(url, directory, name)
+                if downloaded_file:
+                    self.log(f"Downloaded: {downloaded_file}")
+            # Handle resource view pages that need additional processing
+            elif "resource/view.php" in url:
+                downloaded_file = self._process_resource_page(url, directory, name)
+                if downloaded_file:
+                    self.log(f"Downloaded: {downloaded_file}")
+                else:
+                    self.log(f"Warning: Could not extract file from resource page: {name}")
+        except Exception as e:
+            self.log(f"Error processing resource link: {str(e)}")
 
-                self.log(f"Found resource: {name}")
-
-                # Handle direct file downloads
-                if "pluginfile.php" in url:
-                    downloaded_file = self.download_file(url, directory, name)
-                    if downloaded_file:
-                        self.log(f"Downloaded: {downloaded_file}")
-                # Handle resource view pages that need additional processing
-                elif "resource/view.php" in url:
-                    downloaded_file = self._process_resource_page(url, directory, name)
-                    if downloaded_file:
-                        self.log(f"Downloaded: {downloaded_file}")
-                    else:
-                        self.log(f"Warning: Could not extract file from resource page: {name}")
-            except Exception as e:
-                self.log(f"Error processing resource link: {str(e)}")
+    @staticmethod
+    def _is_file_url(url):
+        """Check whether a URL points at a file served by Moodle rather than a page."""
+        return "pluginfile.php" in url and "login" not in url
 
     def _process_resource_page(self, url, directory, name=None):
         """Process a resource view page to find the actual download link."""
@@ -513,34 +855,68 @@ class MoodleDownloader:
 
             self.log(f"Fetching resource page: {url}")
 
-            # Extract resource ID for potential direct download
-            resource_id = None
+            # Extract resource ID for potential direct download, parsing the URL once
             parsed_url = urlparse(url)
-            query_params = parse_qs(parsed_url.query)
-            if 'id' in query_params:
-                resource_id = query_params['id'][0]
+            resource_id = parse_qs(parsed_url.query).get('id', [None])[0]
 
             # Try direct download URL pattern first (this works on many Moodle instances)
             # Format: /mod/resource/view.php?id=XXX&redirect=1
-            if resource_id and 'resource/view.php' in url:
+            if resource_id and parsed_url.path.endswith('resource/view.php'):
                 direct_url = f"{self.base_url}/mod/resource/view.php?id={resource_id}&redirect=1"
+                # Reuse the file URL this resource redirected to on a previous run
+                cached_url = self.manifest["redirects"].get(direct_url)
+                if cached_url and self._is_file_url(cached_url):
+                    self.log(f"Using cached redirect: {cached_url}")
+                    result = self.download_file(cached_url, directory, name)
+                    if result:
+                        return result
+
                 self.log(f"Trying direct download URL: {direct_url}")
 
                 # Follow redirects to get the actual file
-                response = self.session.get(direct_url, allow_redirects=False)
+                for attempt in range(2):
+                    login_generation = self._login_generation
+                    response = self.session.get(direct_url, allow_redirects=False, stream=True,
+                                                timeout=REQUEST_TIMEOUT, headers={'Accept-Encoding': 'identity'})
+                    # If the probe was redirected to a login page, login has expired
+                    if not (response.is_redirect and "login" in response.headers['Location']):
+                        break
+                    response.close()
+                    if attempt == 0:
+                        self._relogin(login_generation)
 
                 # If we got a redirect, follow it to the file
-                if response.status_code in (301, 302, 303, 307, 308) and 'Location' in response.headers:
+                if response.is_redirect and "login" not in response.headers['Location']:
                     file_url = response.headers['Location']
                     if not file_url.startswith(("http://", "https://")):
                         file_url = urljoin(self.base_url, file_url)
 
+                    response.close()
                     self.log(f"Redirected to file: {file_url}")
-                    return self.download_file(file_url, directory, name)
+                    result = self.download_file(file_url, directory, name)
+                    # Only remember redirects that actually produced a file
+                    if result and self._is_file_url(file_url):
+                        with self._manifest_lock:
+                            self.manifest["redirects"][direct_url] = file_url
+                    return result
+
+                # Some instances serve the file itself instead of redirecting to it
+                content_type = response.headers.get('Content-Type', '')
+                if response.status_code == 200 and not content_type.startswith('text/html'):
+                    self.log(f"Direct download served file: {direct_url}")
+                    return self._save_response(response, direct_url, directory, name)
+
+                # A 200 HTML answer is the resource page itself, so reuse it below
+                if response.status_code != 200:
+                    response.close()
+                    response = None
+            else:
+                response = None
 
             # If direct download didn't work, fetch the page and analyze it
-            response = self.session.get(url)
-            soup = BeautifulSoup(response.text, "html.parser")
+            if response is None:
+                response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+            soup = BeautifulSoup(response.text, HTML_PARSER)
 
             # Debug info about the page
             self.log(f"Page title: {soup.title.string if soup.title else 'No title'}")
@@ -548,8 +924,8 @@ class MoodleDownloader:
             # Method 1: Look for a download button or link
             download_links = []
             download_links.extend(soup.select("a.downloadbutton, .resourceworkaround a, .resourcecontent a"))
-            download_links.extend([a for a in soup.find_all('a', href=True) if 'download' in a.get('href', '')])
-            download_links.extend([a for a in soup.find_all('a', href=True) if 'pluginfile.php' in a.get('href', '')])
+            download_links.extend(soup.select('a[href*="download"]'))
+            download_links.extend(soup.select('a[href*="pluginfile.php"]'))
 
             for link in download_links:
                 href = link.get("href", "")
@@ -583,8 +959,8 @@ class MoodleDownloader:
             for script in scripts:
                 if script.string:
                     # Look for file URLs in JavaScript
-                    matches = re.findall(r'(https?://[^"\']*(?:pluginfile\.php|file\.php)[^"\'\s]*)', script.string)
-                    matches.extend(re.findall(r'(\/[^"\']*(?:pluginfile\.php|file\.php)[^"\'\s]*)', script.string))
+                    matches = _JS_ABS_URL_RE.findall(script.string)
+                    matches.extend(_JS_REL_URL_RE.findall(script.string))
 
                     for match in matches:
                         url_to_try = match
@@ -603,11 +979,9 @@ class MoodleDownloader:
                 return self.download_file(content_url, directory, name)
 
             # Method 5: Last resort, check for any link with common file extensions
-            file_extensions = ['.pdf', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.zip', '.rar', '.7z', '.mp3',
-                               '.mp4', '.avi', '.mov', '.jpg', '.jpeg', '.png', '.gif']
             for link in soup.find_all('a', href=True):
                 href = link.get("href", "")
-                if any(href.lower().endswith(ext) for ext in file_extensions):
+                if href.lower().endswith(FILE_EXTENSIONS):
                     if not href.startswith(("http://", "https://")):
                         href = urljoin(self.base_url, href)
                     self.log(f"Found file link by extension: {href}")
@@ -633,7 +1007,7 @@ class MoodleDownloader:
 
             if not cmid:
                 # Try to find it in the URL or body
-                cmid_matches = re.search(r'cmid=(\d+)', response.text)
+                cmid_matches = _CMID_RE.search(response.text)
                 if cmid_matches:
                     cmid = cmid_matches.group(1)
 
@@ -655,11 +1029,12 @@ class MoodleDownloader:
             # No file found
             self.log(f"Could not extract file from resource page. Resource name: {name}, URL: {url}")
 
-            # Save the HTML for debugging
-            debug_file = os.path.join(directory, f"{self.sanitize_filename(name or 'resource')}_debug.html")
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                f.write(response.text)
-            self.log(f"Saved HTML for debugging to: {debug_file}")
+            # Save the HTML for debugging when explicitly requested
+            if self.verbose and os.environ.get("MOODLEDL_DEBUG"):
+                debug_file = os.path.join(directory, f"{self.sanitize_filename(name or 'resource')}_debug.html")
+                with open(debug_file, 'w', encoding='utf-8') as f:
+                    f.write(response.text)
+                self.log(f"Saved HTML for debugging to: {debug_file}")
 
             return None
 
@@ -669,60 +1044,59 @@ class MoodleDownloader:
             self.log(traceback.format_exc())
             return None
 
-    def _process_folders(self, soup, directory):
-        """Process folder modules and download contents."""
-        folder_links = [link for link in soup.find_all("a", href=True)
-                        if "folder/view.php" in link.get("href", "")]
+    def _process_folders(self, links, directory):
+        """Process folder modules from a section's (href, text) links and download contents."""
+        folder_links = [(href, text) for href, text in links if "folder/view.php" in href]
 
-        for link in folder_links:
+        # Numbering for folders without a visible name
+        unnamed_count = 0
+
+        for url, folder_name in folder_links:
             try:
-                url = link["href"]
-                folder_name = link.get_text(strip=True)
+                if not self._is_new_url(url):
+                    continue
 
                 if not folder_name:
-                    folder_name = f"Folder_{len(os.listdir(directory)) + 1}"
+                    unnamed_count += 1
+                    folder_name = f"Folder_{unnamed_count}"
 
                 self.log(f"Processing folder: {folder_name}")
 
                 # Create folder directory
                 folder_dir = os.path.join(directory, self.sanitize_filename(folder_name))
-                os.makedirs(folder_dir, exist_ok=True)
+                self._ensure_dir(folder_dir)
 
                 # Get folder page
-                response = self.session.get(url)
-                folder_soup = BeautifulSoup(response.text, "html.parser")
+                response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+                folder_soup = BeautifulSoup(response.text, HTML_PARSER, parse_only=_LINK_STRAINER)
 
                 # Find all files in the folder
-                for file_link in folder_soup.find_all("a", href=True):
-                    href = file_link.get("href", "")
-                    if "pluginfile.php" in href:
+                for file_link in folder_soup.select('a[href*="pluginfile.php"]'):
+                    href = file_link["href"]
+                    if self._is_new_url(href):
                         file_name = file_link.get_text(strip=True)
-                        self.download_file(href, folder_dir, file_name)
+                        self._submit(self.download_file, href, folder_dir, file_name)
             except Exception as e:
-                self.log(f"Error processing folder {link.get('href', '')}: {str(e)}")
+                self.log(f"Error processing folder {url}: {str(e)}")
 
-    def _process_assignments(self, soup, directory):
-        """Process assignment pages and download any attachments."""
-        assignment_links = [link for link in soup.find_all("a", href=True)
-                            if "assign/view.php" in link.get("href", "")]
+    def _process_assignments(self, links, directory):
+        """Process assignment pages from a section's (href, text) links and download any attachments."""
+        assignment_links = [(href, text) for href, text in links if "assign/view.php" in href]
 
-        for link in assignment_links:
+        for url, name in assignment_links:
             try:
-                url = link["href"]
-                name = link.get_text(strip=True)
-
-                if not name:
+                if not name or not self._is_new_url(url):
                     continue
 
                 self.log(f"Processing assignment: {name}")
 
                 # Create assignment directory
                 assign_dir = os.path.join(directory, self.sanitize_filename(name))
-                os.makedirs(assign_dir, exist_ok=True)
+                self._ensure_dir(assign_dir)
 
                 # Get assignment page
-                response = self.session.get(url)
-                assign_soup = BeautifulSoup(response.text, "html.parser")
+                response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+                assign_soup = BeautifulSoup(response.text, HTML_PARSER)
 
                 # Save assignment description
                 desc_div = assign_soup.select_one(".assignmentinfo, .descriptionbox, .assign-intro")
@@ -733,13 +1107,13 @@ class MoodleDownloader:
                             f.write(desc_text)
 
                 # Download any attached files
-                for file_link in assign_soup.find_all("a", href=True):
-                    href = file_link.get("href", "")
-                    if "pluginfile.php" in href:
+                for file_link in assign_soup.select('a[href*="pluginfile.php"]'):
+                    href = file_link["href"]
+                    if self._is_new_url(href):
                         file_name = file_link.get_text(strip=True)
-                        self.download_file(href, assign_dir, file_name)
+                        self._submit(self.download_file, href, assign_dir, file_name)
             except Exception as e:
-                self.log(f"Error processing assignment {link.get('href', '')}: {str(e)}")
+                self.log(f"Error processing assignment {url}: {str(e)}")
 
     def run(self):
         """Main execution function."""
@@ -747,7 +1121,7 @@ class MoodleDownloader:
         self.log("------------------------")
 
         # Create base download directory
-        os.makedirs(self.download_dir, exist_ok=True)
+        self._ensure_dir(self.download_dir)
 
         # Login to Moodle
         self.login()
@@ -763,22 +1137,41 @@ class MoodleDownloader:
         for i, course in enumerate(courses, 1):
             self.log(f"{i}. {course['name']}")
 
-        # Ask which courses to download
-        selection = input("\nEnter course numbers to download (comma-separated, or 'all'): ")
+        # Ask which courses to download, unless they were given on the command line
+        if self.courses_selection is not None:
+            selection = self.courses_selection
+        else:
+            selection = input("\nEnter course numbers to download (comma-separated, or 'all'): ")
 
-        if selection.lower() == 'all':
+        if selection.strip().lower() == 'all':
             selected_courses = courses
         else:
             try:
                 indices = [int(idx.strip()) - 1 for idx in selection.split(',')]
-                selected_courses = [courses[idx] for idx in indices if 0 <= idx < len(courses)]
             except ValueError:
+                # A bad command-line value is an error; only the prompt falls back to everything
+                if self.courses_selection is not None:
+                    raise ValueError(f"Invalid course selection: {selection}")
                 self.log("Invalid selection. Downloading all courses.")
-                selected_courses = courses
+                indices = range(len(courses))
+            if self.courses_selection is not None and not all(0 <= idx < len(courses) for idx in indices):
+                raise ValueError(f"Course selection {selection} is out of range (1-{len(courses)})")
+            selected_courses = [courses[idx] for idx in indices if 0 <= idx < len(courses)]
 
         # Download each selected course
-        for course in selected_courses:
-            self.process_course(course)
+        try:
+            # Scan the next course while earlier courses are still downloading
+            for course in selected_courses:
+                self.process_course(course, wait=False)
+                self.save_manifest()
+
+            self._wait_for_downloads()
+        finally:
+            # Drop queued downloads on interruption and let running ones finish
+            for future in self._pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.save_manifest()
 
         self.log("\nDownload complete! Files saved to: " + self.download_dir)
 
@@ -791,8 +1184,14 @@ def main():
     parser.add_argument("-d", "--directory", help="Download directory")
     parser.add_argument("-q", "--quiet", action="store_true", help="Quiet mode (less output)")
     parser.add_argument("-f", "--force", action="store_true", help="Force re-download of existing files")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of concurrent downloads")
+    parser.add_argument("-c", "--courses", help="Courses to download without prompting (e.g., 'all' or '1,3')")
 
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error(f"argument -w/--workers: must be at least 1, got {args.workers}")
+    if args.courses is not None and not _COURSES_SELECTION_RE.match(args.courses):
+        parser.error(f"argument -c/--courses: invalid selection '{args.courses}' (use 'all' or e.g. '1,3')")
 
     downloader = MoodleDownloader(
         base_url=args.url,
@@ -800,7 +1199,9 @@ def main():
         password=args.password,
         download_dir=args.directory,
         verbose=not args.quiet,
-        force_download=args.force  # Add this parameter
+        force_download=args.force,  # Add this parameter
+        max_workers=args.workers,
+        courses_selection=args.courses
     )
 
     try: